@@ -1,14 +1,35 @@
 import os
 import time
 import random
+from contextlib import ExitStack
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv
+from rerun_profiler import (ProfileStore, RerunProfiler, PROFILE_QUERY_PARAM,
+                            profiling_enabled_by_env, profiling_requested, sample_rate_from_env)
+from token_budget import BudgetExceeded, TokenGovernor, DEFAULT_TENANT
+
+# Taken before anything else so module-level work (page config, client setup) counts
+# towards the profiled rerun as its module_setup phase.
+SCRIPT_STARTED = time.perf_counter()
 
 # --- 0. Streamlit Page Configuration ---
 st.set_page_config(page_title="OSCE Chatbot", page_icon="⚕️")
 
+# --- Rerun Profiler (opt-in via OSCE_PROFILE=1 or ?profile=1) ---
+@st.cache_resource(show_spinner=False)
+def get_profile_store() -> ProfileStore:
+    # One store per server process so timings survive session resets.
+    return ProfileStore()
+
+PROFILER = RerunProfiler(
+    get_profile_store(),
+    enabled=profiling_requested(st.query_params.get(PROFILE_QUERY_PARAM)),
+    sample_rate=sample_rate_from_env()
+)
+
 # --- Main App Title and Subtitle ---
 st.title("💊 OSCE Patient Simulator")
 st.markdown("### by PharmicoLearn")
@@ -99,27 +120,55 @@ def load_prompt(filename: str) -> str:
         st.error(f"Error: Prompt file not found at '{file_path}'. Please ensure the 'prompts' folder and file exist.")
         return "You are a helpful assistant. Please respond to user queries."
 
+def metered_generate_content(gemini_client_models,
+                             model_name: str,
+                             contents_to_send: list,
+                             config: types.GenerateContentConfig,
+                             check_budget: bool = True):
+    """
+    Makes one model call through the token governor: waits for a fair-share slot, calls the
+    model and records the tokens used. The wait and the call are profiled as separate
+    'queue_wait' and 'model_call' phases. Raises BudgetExceeded if the budget is used up.
+    """
+    with ExitStack() as slot:
+        with PROFILER.phase("queue_wait"):
+            ticket = slot.enter_context(GOVERNOR.generation(TENANT, STUDENT, check_budget=check_budget))
+        with PROFILER.phase("model_call"):
+            response = gemini_client_models.generate_content(
+                model=model_name,
+                contents=contents_to_send,
+                config=config
+            )
+        ticket.record(response)
+    return response
+
 def generate_content_with_retry(gemini_client_models,
                                 model_name: str,
                                 contents_to_send: list,
                                 config: types.GenerateContentConfig,
                                 max_retries: int = 5,
-                                initial_delay: int = 1):
+                                initial_delay: int = 1,
+                                check_budget: bool = True):
     """
     Sends content to the Gemini model with retry logic for temporary API issues.
     Incorporates Streamlit's spinner for better UX.
+    Each attempt takes its own scheduler slot, so backoff sleeps don't hold one.
     Returns the full GenerateContentResponse object.
     """
     delay = initial_delay
     for i in range(max_retries):
         try:
             with st.spinner("Thinking..."):
-                response = gemini_client_models.generate_content(
-                    model=model_name,
-                    contents=contents_to_send,
-                    config=config
+                response = metered_generate_content(
+                    gemini_client_models,
+                    model_name,
+                    contents_to_send,
+                    config,
+                    check_budget=check_budget
                 )
             return response
+        except BudgetExceeded:
+            raise
         except Exception as e:
             error_message = str(e).lower()
             if "overloaded" in error_message or "503" in error_message or "unavailable" in error_message or "resource_exhausted" in error_message:
@@ -132,6 +181,98 @@ def generate_content_with_retry(gemini_client_models,
                 raise
     raise Exception(f"Failed after {max_retries} retries due to persistent model unavailability.")
 
+# --- Rerun Profiler Panel ---
+def render_profiler_panel(profiler: RerunProfiler):
+    """
+    Shows aggregated rerun phase timings in the sidebar, with exports for offline analysis.
+    Exports and reset are process-wide (and cProfile dumps contain server file paths), so
+    they are only offered when profiling was enabled server-side via OSCE_PROFILE, not ?profile=1.
+    """
+    store = profiler.store
+    with st.sidebar.expander("⏱️ Rerun Profiler", expanded=True):
+        st.caption(f"{store.reruns} reruns recorded · cProfile sample rate {profiler.sample_rate:.0%}")
+        rows = store.summary()
+        if rows:
+            st.dataframe(
+                [{k: (round(v, 1) if isinstance(v, float) else v) for k, v in row.items()} for row in rows],
+                hide_index=True
+            )
+        else:
+            st.info("No reruns recorded yet.")
+
+        if not profiling_enabled_by_env():
+            st.caption("Exports and reset require OSCE_PROFILE=1 on the server.")
+            return
+
+        st.download_button(
+            "Download collapsed stacks",
+            data=store.export_collapsed(),
+            file_name="osce_reruns.folded",
+            mime="text/plain",
+            key="profiler_download_collapsed"
+        )
+        st.download_button(
+            "Download summary (JSON)",
+            data=store.export_json(),
+            file_name="osce_reruns.json",
+            mime="application/json",
+            key="profiler_download_json"
+        )
+        dumps = store.dumps()
+        if dumps:
+            st.download_button(
+                f"Download latest cProfile dump ({dumps[-1]['rerun_ms']:.0f} ms rerun)",
+                data=dumps[-1]["pstats"],
+                file_name="osce_rerun.prof",
+                mime="application/octet-stream",
+                key="profiler_download_pstats"
+            )
+        if st.button("Reset profiler", key="profiler_reset_button"):
+            store.reset()
+            st.rerun()
+
+# --- Token Budgets & Fair-Share Scheduling (shared across all sessions) ---
+@st.cache_resource
+def get_token_governor() -> TokenGovernor:
+    return TokenGovernor.from_env()
+
+def current_identity() -> tuple:
+    """
+    Returns (institution, student) for token accounting.
+    The institution is resolved server-side: the ?access= code is looked up in the
+    [institution_access_codes] table of st.secrets ({code = "institution"}); missing or
+    unknown codes share the DEFAULT_TENANT budget.
+    The student id is client-supplied (?student=, else the browser session id), so
+    per-student budgets are advisory: a reload or new tab starts a fresh student budget.
+    Institution budgets are the enforced limit.
+    """
+    try:
+        access_codes = dict(st.secrets.get("institution_access_codes", {}))
+    except Exception: # No secrets file configured
+        access_codes = {}
+    tenant = access_codes.get(st.query_params.get("access", ""), DEFAULT_TENANT)
+    student = st.query_params.get("student")
+    if not student:
+        ctx = get_script_run_ctx()
+        student = ctx.session_id if ctx else "anonymous"
+    return tenant, student
+
+def render_token_usage(governor: TokenGovernor, tenant: str, student: str):
+    if not (governor.student_budget or governor.tenant_budget):
+        return
+    with st.sidebar:
+        if governor.student_budget:
+            used = governor.ledger.window_usage(tenant, student)
+            st.progress(min(used / governor.student_budget, 1.0),
+                        text=f"Your tokens: {used:,} / {governor.student_budget:,}")
+        if governor.tenant_budget:
+            used = governor.ledger.window_usage(tenant)
+            st.progress(min(used / governor.tenant_budget, 1.0),
+                        text=f"{tenant} tokens: {used:,} / {governor.tenant_budget:,}")
+
+GOVERNOR = get_token_governor()
+TENANT, STUDENT = current_identity()
+
 # --- Function to Reset App State (called by button's on_click) ---
 def reset_app_state_and_rerun():
     st.session_state.clear()
@@ -141,25 +282,26 @@ def reset_app_state_and_rerun():
 def main():
     # The title and subtitle are in the global scope.
 
-    # --- NEW: Display App Description ---
-    st.markdown(APP_DESCRIPTION)
-    # --- END NEW ---
-
-    # Initialize essential session state variables
-    if "consultation_begun" not in st.session_state:
-        st.session_state.consultation_begun = False
-    if "scenario_generated" not in st.session_state:
-        st.session_state.scenario_generated = False
-    if "history" not in st.session_state:
-        st.session_state.history = []
-    if "initial_scenario_message" not in st.session_state:
-        st.session_state.initial_scenario_message = ""
-    if "consultation_concluded_by_patient" not in st.session_state:
-        st.session_state.consultation_concluded_by_patient = False
-    if "feedback_generated" not in st.session_state:
-        st.session_state.feedback_generated = False
-    if "selected_topic" not in st.session_state:
-        st.session_state.selected_topic = None
+    with PROFILER.phase("setup"):
+        # --- NEW: Display App Description ---
+        st.markdown(APP_DESCRIPTION)
+        # --- END NEW ---
+
+        # Initialize essential session state variables
+        if "consultation_begun" not in st.session_state:
+            st.session_state.consultation_begun = False
+        if "scenario_generated" not in st.session_state:
+            st.session_state.scenario_generated = False
+        if "history" not in st.session_state:
+            st.session_state.history = []
+        if "initial_scenario_message" not in st.session_state:
+            st.session_state.initial_scenario_message = ""
+        if "consultation_concluded_by_patient" not in st.session_state:
+            st.session_state.consultation_concluded_by_patient = False
+        if "feedback_generated" not in st.session_state:
+            st.session_state.feedback_generated = False
+        if "selected_topic" not in st.session_state:
+            st.session_state.selected_topic = None
 
 
     # --- Topic Selection and Start Consultation Button (Conditional Display) ---
@@ -210,33 +352,45 @@ def main():
                     temperature=0.8,
                     max_output_tokens=300
                 )
-                initial_response = client.models.generate_content(
-                    model=GEMINI_MODEL,
-                    contents=st.session_state.history,
-                    config=initial_call_config
+                initial_response = metered_generate_content(
+                    client.models,
+                    GEMINI_MODEL,
+                    st.session_state.history,
+                    initial_call_config
                 )
                 initial_bot_message = initial_response.text
                 st.session_state.history.append(types.Content(role="model", parts=[types.Part(text=initial_bot_message)]))
                 st.session_state.initial_scenario_message = initial_bot_message
                 st.session_state.scenario_generated = True
                 st.rerun() # Rerun to display the generated scenario
+            except BudgetExceeded as e:
+                # Return to topic selection so later reruns don't retry the call and stop again.
+                st.session_state.consultation_begun = False
+                st.warning(f"{e} Please try again later.")
+                st.button(
+                    "Start New Consultation",
+                    on_click=reset_app_state_and_rerun,
+                    key="reset_button_budget_exceeded"
+                )
+                st.stop()
             except Exception as e:
                 st.error(f"Failed to generate initial scenario: {e}")
                 st.exception(e) # Display full traceback
                 st.stop()
         
         # --- Display Chat History ---
-        if st.session_state.scenario_generated and st.session_state.initial_scenario_message:
-            with st.chat_message("assistant", avatar="👤"): # Bot's initial message
-                st.markdown(st.session_state.initial_scenario_message)
-
-        for i, message in enumerate(st.session_state.history[2:]):
-            if message.role == "user":
-                with st.chat_message("user", avatar="🧑‍⚕️"): # User messages
-                    st.markdown(message.parts[0].text)
-            else: # Must be "model" role
-                with st.chat_message("assistant", avatar="👤"): # Bot messages
-                    st.markdown(message.parts[0].text)
+        with PROFILER.phase("history_render"):
+            if st.session_state.scenario_generated and st.session_state.initial_scenario_message:
+                with st.chat_message("assistant", avatar="👤"): # Bot's initial message
+                    st.markdown(st.session_state.initial_scenario_message)
+
+            for i, message in enumerate(st.session_state.history[2:]):
+                if message.role == "user":
+                    with st.chat_message("user", avatar="🧑‍⚕️"): # User messages
+                        st.markdown(message.parts[0].text)
+                else: # Must be "model" role
+                    with st.chat_message("assistant", avatar="👤"): # Bot messages
+                        st.markdown(message.parts[0].text)
 
         # --- Interactive Chat Input ---
         if not st.session_state.consultation_concluded_by_patient and not st.session_state.feedback_generated:
@@ -263,10 +417,11 @@ def main():
                         max_output_tokens=300
                     )
                     try:
-                        response = client.models.generate_content(
-                            model=GEMINI_MODEL,
-                            contents=st.session_state.history,
-                            config=chat_config
+                        response = metered_generate_content(
+                            client.models,
+                            GEMINI_MODEL,
+                            st.session_state.history,
+                            chat_config
                         )
                         reply = response.text
 
@@ -283,6 +438,9 @@ def main():
                             st.session_state.history.append(types.Content(role="model", parts=[types.Part(text=reply)]))
                             with st.chat_message("assistant", avatar="👤"): # Bot's regular message
                                 st.markdown(reply)
+                    except BudgetExceeded as e:
+                        st.session_state.history.pop() # Drop the unanswered message so it isn't replayed
+                        st.warning(f"{e} Type 'quit' to get feedback on the consultation so far.")
                     except Exception as e:
                         st.error(f"Error generating patient response: {e}")
                         st.exception(e) # Display full traceback
@@ -303,12 +461,16 @@ def main():
                 max_output_tokens=1000
             )
             try:
-                feedback_response = generate_content_with_retry(
-                    gemini_client_models=client.models,
-                    model_name=GEMINI_MODEL,
-                    contents_to_send=feedback_history,
-                    config=feedback_config
-                )
+                # Feedback is exempt from the budget check so a student who ran out
+                # mid-consultation can still type 'quit' and be assessed.
+                with PROFILER.phase("feedback"):
+                    feedback_response = generate_content_with_retry(
+                        gemini_client_models=client.models,
+                        model_name=GEMINI_MODEL,
+                        contents_to_send=feedback_history,
+                        config=feedback_config,
+                        check_budget=False
+                    )
                 feedback_text = feedback_response.text
 
                 if feedback_text:
@@ -327,4 +489,16 @@ def main():
             )
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # The profiler (and any sampled cProfile) starts here, inside the try, so nothing can
+    # leave it running; module-level work is recorded retroactively from SCRIPT_STARTED.
+    PROFILER.begin(started_at=SCRIPT_STARTED)
+    try:
+        PROFILER.add_phase("module_setup", SCRIPT_STARTED)
+        render_token_usage(GOVERNOR, TENANT, STUDENT)
+        main()
+    finally:
+        # st.rerun()/st.stop() raise out of main(), so finish timing and draw the panel here,
+        # after this rerun's phases have been recorded.
+        PROFILER.finish()
+        if PROFILER.enabled:
+            render_profiler_panel(PROFILER)
\ No newline at end of file
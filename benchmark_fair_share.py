@@ -0,0 +1,100 @@
+"""
+Simulation benchmark for the fair-share scheduler in token_budget.py.
+
+Replays a skewed user mix against a simulated model (latency proportional to tokens)
+with limited concurrency, once first-come-first-served and once with fair-share
+ordering, and reports queueing latency for light and heavy students.
+No API key is needed:
+
+    python benchmark_fair_share.py [--seed 7] [--time-scale 0.00002]
+"""
+import time
+import random
+import argparse
+import threading
+from types import SimpleNamespace
+
+from token_budget import TokenGovernor, TokenLedger
+
+########################################################################
+#                         SIMULATED USER MIX                           #
+########################################################################
+# (institution, number of students, consultations each, turns per consultation, tokens per turn)
+USER_MIX = [
+    ("uni-a", 3, 4, 20, 2500), # Heavy: long consultations and repeated "Start New Consultation" loops
+    ("uni-a", 10, 1, 5, 600),
+    ("uni-b", 12, 1, 5, 600),
+]
+MAX_CONCURRENT = 2
+THINK_TIME = (0.05, 0.2) # Seconds a light student spends typing between turns
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def simulated_model_call(tokens: int, time_scale: float):
+    time.sleep(tokens * time_scale)
+    return SimpleNamespace(usage_metadata=SimpleNamespace(total_token_count=tokens))
+
+
+def run(fair_share: bool, seed: int, time_scale: float) -> dict:
+    rng = random.Random(seed)
+    governor = TokenGovernor(TokenLedger(half_life_seconds=5), max_concurrent=MAX_CONCURRENT, fair_share=fair_share)
+    waits = {"light": [], "heavy": []}
+    waits_lock = threading.Lock()
+
+    def student(tenant, name, kind, consultations, turns, tokens, start_delay, think_times):
+        time.sleep(start_delay)
+        for _ in range(consultations):
+            for turn in range(turns):
+                requested_at = time.perf_counter()
+                with governor.generation(tenant, name) as ticket:
+                    waited = time.perf_counter() - requested_at
+                    ticket.record(simulated_model_call(tokens, time_scale))
+                with waits_lock:
+                    waits[kind].append(waited)
+                if kind == "light":
+                    time.sleep(think_times[turn])
+
+    threads = []
+    for tenant, count, consultations, turns, tokens in USER_MIX:
+        kind = "heavy" if tokens * turns * consultations > 10000 else "light"
+        for i in range(count):
+            # Heavy students arrive first and keep the queue full; light ones trickle in.
+            start_delay = 0.0 if kind == "heavy" else rng.uniform(0.1, 4.0)
+            think_times = [rng.uniform(*THINK_TIME) for _ in range(turns)]
+            threads.append(threading.Thread(
+                target=student,
+                args=(tenant, f"{tenant}-{kind}-{i}", kind, consultations, turns, tokens, start_delay, think_times)
+            ))
+
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return {"waits": waits, "elapsed": time.perf_counter() - started}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--time-scale", type=float, default=0.00002, help="Simulated seconds per token")
+    args = parser.parse_args()
+
+    print(f"{'policy':<12}{'users':<8}{'calls':>7}{'p50 wait ms':>14}{'p95 wait ms':>14}{'max wait ms':>14}")
+    for label, fair_share in (("fifo", False), ("fair-share", True)):
+        result = run(fair_share, args.seed, args.time_scale)
+        for kind in ("light", "heavy"):
+            w = result["waits"][kind]
+            print(f"{label:<12}{kind:<8}{len(w):>7}"
+                  f"{percentile(w, 0.5) * 1000:>14.1f}{percentile(w, 0.95) * 1000:>14.1f}{max(w) * 1000:>14.1f}")
+        print(f"{label:<12}total run time {result['elapsed']:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import os
+import time
+import json
+import random
+import marshal
+import cProfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# --- Opt-in switches ---
+# Profiling is off unless OSCE_PROFILE is set (e.g. OSCE_PROFILE=1) or the page is
+# opened with ?profile=1. OSCE_PROFILE_SAMPLE is the fraction of reruns that are
+# also run under cProfile (0 disables cProfile dumps entirely).
+PROFILE_ENV_VAR = "OSCE_PROFILE"
+PROFILE_QUERY_PARAM = "profile"
+PROFILE_SAMPLE_ENV_VAR = "OSCE_PROFILE_SAMPLE"
+
+ROOT_PHASE = "rerun"
+MAX_SAMPLES_PER_PHASE = 500 # Recent durations kept for percentiles
+MAX_PROFILE_DUMPS = 10 # cProfile dumps kept in memory
+
+_TRUTHY = ("1", "true", "yes", "on")
+
+
+def profiling_enabled_by_env() -> bool:
+    """
+    Returns True if the operator switched profiling on server-side via OSCE_PROFILE.
+    """
+    return os.getenv(PROFILE_ENV_VAR, "").strip().lower() in _TRUTHY
+
+
+def profiling_requested(query_value=None) -> bool:
+    """
+    Returns True if profiling was switched on by environment variable or query param value.
+    """
+    if profiling_enabled_by_env():
+        return True
+    if isinstance(query_value, (list, tuple)):
+        query_value = query_value[0] if query_value else None
+    return query_value is not None and str(query_value).strip().lower() in _TRUTHY
+
+
+def sample_rate_from_env(default: float = 0.0) -> float:
+    """
+    Reads the cProfile sampling rate from the environment, clamped to [0, 1].
+    """
+    try:
+        rate = float(os.getenv(PROFILE_SAMPLE_ENV_VAR, default))
+    except ValueError:
+        return default
+    return min(max(rate, 0.0), 1.0)
+
+
+def _percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class PhaseStats:
+    """
+    Running totals for one phase path (e.g. 'rerun;history_render').
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.last = 0.0
+        self.samples = deque(maxlen=MAX_SAMPLES_PER_PHASE)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.last = seconds
+        self.samples.append(seconds)
+
+    def summary(self) -> dict:
+        ordered = sorted(self.samples)
+        return {
+            "count": self.count,
+            "total_ms": self.total * 1000,
+            "mean_ms": (self.total / self.count) * 1000 if self.count else 0.0,
+            "p50_ms": _percentile(ordered, 0.50) * 1000,
+            "p95_ms": _percentile(ordered, 0.95) * 1000,
+            "min_ms": (self.min or 0.0) * 1000,
+            "max_ms": self.max * 1000,
+            "last_ms": self.last * 1000,
+        }
+
+
+class ProfileStore:
+    """
+    In-memory, thread-safe aggregate of phase timings and sampled cProfile dumps.
+    Streamlit runs each session's script in its own thread, so one store is shared
+    by every session in the process.
+    """
+
+    def __init__(self, max_dumps: int = MAX_PROFILE_DUMPS):
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._dumps = deque(maxlen=max_dumps)
+        self.reruns = 0
+
+    def record_phase(self, path: tuple, seconds: float):
+        key = ";".join(path)
+        with self._lock:
+            stats = self._phases.get(key)
+            if stats is None:
+                stats = self._phases[key] = PhaseStats()
+            stats.add(seconds)
+            if path == (ROOT_PHASE,):
+                self.reruns += 1
+
+    def record_dump(self, profile: cProfile.Profile, seconds: float):
+        profile.create_stats()
+        dump = {
+            "captured_at": time.time(),
+            "rerun_ms": seconds * 1000,
+            "pstats": marshal.dumps(profile.stats),
+        }
+        with self._lock:
+            self._dumps.append(dump)
+
+    def reset(self):
+        with self._lock:
+            self._phases.clear()
+            self._dumps.clear()
+            self.reruns = 0
+
+    def summary(self) -> list:
+        """
+        Returns one row per phase path, ordered so children follow their parent.
+        """
+        with self._lock:
+            rows = [dict(phase=key, **stats.summary()) for key, stats in self._phases.items()]
+        rows.sort(key=lambda row: row["phase"])
+        return rows
+
+    def dumps(self) -> list:
+        with self._lock:
+            return list(self._dumps)
+
+    def export_collapsed(self) -> str:
+        """
+        Exports cumulative phase time in collapsed-stack format ('a;b;c <value>'),
+        as consumed by flamegraph.pl, speedscope and similar tools. Values are
+        self time in microseconds so nested phases are not double counted.
+        """
+        with self._lock:
+            totals = {key: stats.total for key, stats in self._phases.items()}
+        self_times = dict(totals)
+        for key, total in totals.items():
+            if ";" in key:
+                parent = key.rsplit(";", 1)[0]
+                if parent in self_times:
+                    self_times[parent] -= total
+        lines = []
+        for key in sorted(self_times):
+            micros = int(max(self_times[key], 0.0) * 1_000_000)
+            if micros:
+                lines.append(f"{key} {micros}")
+        return "\n".join(lines) + ("\n" if lines else "")
+
+    def export_json(self) -> str:
+        dumps = [
+            {"captured_at": d["captured_at"], "rerun_ms": d["rerun_ms"]}
+            for d in self.dumps()
+        ]
+        return json.dumps(
+            {"reruns": self.reruns, "phases": self.summary(), "profile_dumps": dumps},
+            indent=2
+        )
+
+
+class RerunProfiler:
+    """
+    Times the named phases of a single script rerun and reports them to a ProfileStore.
+    When disabled every method is a cheap no-op, so call sites do not need guards.
+    """
+
+    def __init__(self, store: ProfileStore, enabled: bool = False, sample_rate: float = 0.0):
+        self.store = store
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self._stack = []
+        self._profile = None
+        self._started_at = None
+
+    def begin(self, started_at: float = None):
+        """
+        Starts timing a rerun; pair with finish() in a finally (or use rerun()).
+        started_at is a time.perf_counter() value taken earlier, e.g. at the top of the
+        script, so work done before the profiler existed still counts towards the rerun.
+        """
+        if not self.enabled or self._started_at is not None:
+            return
+
+        if self.sample_rate and random.random() < self.sample_rate:
+            self._profile = cProfile.Profile()
+            try:
+                self._profile.enable()
+            except ValueError:
+                # Another session's rerun is already being profiled (only one
+                # profiler may be active per process); skip this sample.
+                self._profile = None
+
+        self._stack = [(ROOT_PHASE, None)]
+        self._started_at = time.perf_counter() if started_at is None else started_at
+
+    def finish(self):
+        """
+        Records the rerun started by begin(), closing any phases still open. Safe to call twice.
+        """
+        if self._started_at is None:
+            return
+        while len(self._stack) > 1:
+            self.end_phase()
+        elapsed = time.perf_counter() - self._started_at
+        if self._profile is not None:
+            self._profile.disable()
+            self.store.record_dump(self._profile, elapsed)
+            self._profile = None
+        self.store.record_phase((ROOT_PHASE,), elapsed)
+        self._stack = []
+        self._started_at = None
+
+    @contextmanager
+    def rerun(self, started_at: float = None):
+        """
+        Wraps a whole rerun. Streamlit's st.rerun()/st.stop() raise to end the script
+        early, so timings are recorded in a finally block and the exception re-raised.
+        """
+        self.begin(started_at)
+        try:
+            yield
+        finally:
+            self.finish()
+
+    def start_phase(self, name: str):
+        """
+        Opens a named phase; for code that cannot be wrapped in phase().
+        """
+        if self.enabled:
+            self._stack.append((name, time.perf_counter()))
+
+    def end_phase(self):
+        """
+        Closes the innermost phase opened with start_phase() and records it.
+        """
+        if not self.enabled or len(self._stack) < 2:
+            return
+        path = tuple(name for name, _ in self._stack)
+        _, started_at = self._stack.pop()
+        self.store.record_phase(path, time.perf_counter() - started_at)
+
+    def add_phase(self, name: str, started_at: float):
+        """
+        Records a phase that ran from started_at (a time.perf_counter() value) until now,
+        for work that finished before begin() was called.
+        """
+        if not self.enabled or not self._stack:
+            return
+        path = tuple(n for n, _ in self._stack) + (name,)
+        self.store.record_phase(path, time.perf_counter() - started_at)
+
+    @contextmanager
+    def phase(self, name: str):
+        """
+        Times a named phase. Phases may nest; they are keyed by their full path.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        self.start_phase(name)
+        try:
+            yield
+        finally:
+            self.end_phase()
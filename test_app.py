@@ -0,0 +1,18 @@
+import pytest
+
+AppTest = pytest.importorskip("streamlit.testing.v1").AppTest
+
+
+@pytest.mark.parametrize("profile", [False, True])
+def test_first_load_renders_topic_selection(monkeypatch, profile):
+    # First run after a server start: cache_resource misses must not draw anything
+    # before st.set_page_config.
+    monkeypatch.setenv("GEMINI_API_KEY", "test-key")
+    if profile:
+        monkeypatch.setenv("OSCE_PROFILE", "1")
+    else:
+        monkeypatch.delenv("OSCE_PROFILE", raising=False)
+    at = AppTest.from_file("app.py", default_timeout=30)
+    at.run()
+    assert not at.exception
+    assert at.selectbox(key="topic_selector").value == "Random (select from list)"
@@ -0,0 +1,106 @@
+import pytest
+
+from rerun_profiler import (PROFILE_ENV_VAR, PROFILE_SAMPLE_ENV_VAR, ProfileStore, RerunProfiler,
+                            profiling_requested, sample_rate_from_env)
+
+
+def test_export_collapsed_subtracts_children_from_parent():
+    store = ProfileStore()
+    store.record_phase(("rerun",), 1.0)
+    store.record_phase(("rerun", "setup"), 0.25)
+    store.record_phase(("rerun", "model_call"), 0.5)
+    store.record_phase(("rerun", "feedback"), 0.1)
+    store.record_phase(("rerun", "feedback", "model_call"), 0.3) # Overlapping timers: never negative
+    lines = dict(line.rsplit(" ", 1) for line in store.export_collapsed().splitlines())
+    assert lines == {
+        "rerun": "150000",
+        "rerun;setup": "250000",
+        "rerun;model_call": "500000",
+        "rerun;feedback;model_call": "300000",
+    }
+
+
+def test_export_collapsed_empty_store():
+    assert ProfileStore().export_collapsed() == ""
+
+
+def test_finish_closes_phases_left_open():
+    store = ProfileStore()
+    profiler = RerunProfiler(store, enabled=True)
+    profiler.begin()
+    profiler.start_phase("setup")
+    profiler.start_phase("inner")
+    profiler.finish()
+    assert {row["phase"] for row in store.summary()} == {"rerun", "rerun;setup", "rerun;setup;inner"}
+    profiler.finish() # Safe to call twice
+    assert store.reruns == 1
+
+
+def test_reruns_only_count_root_path():
+    store = ProfileStore()
+    profiler = RerunProfiler(store, enabled=True)
+    for _ in range(3):
+        with profiler.rerun():
+            with profiler.phase("setup"):
+                pass
+            profiler.add_phase("module_setup", 0.0)
+    assert store.reruns == 3
+    assert {row["phase"]: row["count"] for row in store.summary()} == {
+        "rerun": 3, "rerun;setup": 3, "rerun;module_setup": 3
+    }
+
+
+def test_disabled_profiler_records_nothing():
+    store = ProfileStore()
+    profiler = RerunProfiler(store, enabled=False, sample_rate=1.0)
+    with profiler.rerun():
+        with profiler.phase("setup"):
+            pass
+    assert store.summary() == [] and store.dumps() == []
+
+
+def test_sampled_rerun_keeps_cprofile_dump():
+    store = ProfileStore()
+    with RerunProfiler(store, enabled=True, sample_rate=1.0).rerun():
+        sum(range(1000))
+    assert len(store.dumps()) == 1
+
+
+@pytest.mark.parametrize("value, expected", [
+    (None, False),
+    ("1", True),
+    ("TRUE", True),
+    (" yes ", True),
+    ("on", True),
+    ("0", False),
+    ("false", False),
+    (["1", "0"], True),
+    (["0", "1"], False),
+    ([], False),
+    (("true",), True),
+])
+def test_profiling_requested_query_values(monkeypatch, value, expected):
+    monkeypatch.delenv(PROFILE_ENV_VAR, raising=False)
+    assert profiling_requested(value) is expected
+
+
+def test_profiling_requested_by_env(monkeypatch):
+    monkeypatch.setenv(PROFILE_ENV_VAR, "1")
+    assert profiling_requested(None) is True
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("0.25", 0.25),
+    ("5", 1.0),
+    ("-1", 0.0),
+    ("not-a-number", 0.0),
+    ("", 0.0),
+])
+def test_sample_rate_from_env_clamps_and_rejects_bad_input(monkeypatch, raw, expected):
+    monkeypatch.setenv(PROFILE_SAMPLE_ENV_VAR, raw)
+    assert sample_rate_from_env() == expected
+
+
+def test_sample_rate_from_env_default(monkeypatch):
+    monkeypatch.delenv(PROFILE_SAMPLE_ENV_VAR, raising=False)
+    assert sample_rate_from_env() == 0.0
@@ -0,0 +1,151 @@
+import threading
+import time
+
+import pytest
+
+from token_budget import BudgetExceeded, FairShareScheduler, TokenGovernor, TokenLedger
+
+
+def _wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.001)
+    return predicate()
+
+
+@pytest.mark.parametrize("fair_share", [False, True])
+def test_free_slot_with_waiters_admits_head(fair_share):
+    # Both holders release at once; every freed slot must go to a waiter without
+    # any further release, even if a non-head waiter wakes up first.
+    for _ in range(20):
+        scheduler = FairShareScheduler(TokenLedger(), max_concurrent=2, fair_share=fair_share)
+        release_holders = threading.Event()
+        finish = threading.Event()
+        admitted = []
+
+        def holder():
+            with scheduler.slot("t", "holder"):
+                release_holders.wait()
+
+        def waiter(i):
+            with scheduler.slot("t", f"waiter-{i}"):
+                admitted.append(i)
+                finish.wait()
+
+        threads = [threading.Thread(target=holder) for _ in range(2)]
+        for t in threads:
+            t.start()
+        assert _wait_until(lambda: scheduler._active == 2)
+        for i in range(4):
+            t = threading.Thread(target=waiter, args=(i,))
+            threads.append(t)
+            t.start()
+            assert _wait_until(lambda: scheduler.pending == i + 1)
+
+        release_holders.set()
+        try:
+            assert _wait_until(lambda: len(admitted) == 2, timeout=1.0), "free slot left idle while waiters queued"
+            assert sorted(admitted) == [0, 1]
+        finally:
+            finish.set()
+            for t in threads:
+                t.join(timeout=2.0)
+        assert sorted(admitted) == [0, 1, 2, 3]
+
+
+def test_fair_share_admits_lightest_consumer_first():
+    ledger = TokenLedger()
+    ledger.record("t", "heavy", 10000)
+    scheduler = FairShareScheduler(ledger, max_concurrent=1)
+    release = threading.Event()
+    order = []
+
+    def run(student):
+        with scheduler.slot("t", student):
+            order.append(student)
+            if student == "holder":
+                release.wait()
+
+    threads = [threading.Thread(target=run, args=("holder",))]
+    threads[0].start()
+    assert _wait_until(lambda: order == ["holder"])
+    for student in ("heavy", "light"):
+        t = threading.Thread(target=run, args=(student,))
+        threads.append(t)
+        t.start()
+        assert _wait_until(lambda: scheduler.pending == len(threads) - 1)
+    release.set()
+    for t in threads:
+        t.join(timeout=2.0)
+    assert order == ["holder", "light", "heavy"]
+
+
+def test_budgets_are_enforced_per_student_and_tenant():
+    governor = TokenGovernor(TokenLedger(), student_budget=100, tenant_budget=150)
+    governor.ledger.record("t", "s1", 110)
+    with pytest.raises(BudgetExceeded) as exc:
+        governor.check_budget("t", "s1")
+    assert exc.value.scope == "student"
+    governor.ledger.record("t", "s2", 50)
+    with pytest.raises(BudgetExceeded) as exc:
+        governor.check_budget("t", "s3")
+    assert exc.value.scope == "institution"
+    governor.check_budget("other", "s1")
+
+
+def test_ledger_evicts_idle_keys():
+    clock = [0.0]
+    ledger = TokenLedger(window_seconds=100, half_life_seconds=10, clock=lambda: clock[0])
+    for i in range(50):
+        ledger.record("t", f"session-{i}", 500)
+    assert len(ledger) == 51
+    clock[0] = 1000.0 # Past the window, and 100 half-lives of decay
+    ledger.record("t", "active", 10)
+    assert len(ledger) == 2
+    assert ledger.window_usage("t") == 10
+    assert [row["student"] for row in ledger.snapshot()] == ["active", "(all)"]
+
+
+def test_budget_rechecked_after_waiting_for_slot():
+    governor = TokenGovernor(TokenLedger(), tenant_budget=100, max_concurrent=1)
+    holding = threading.Event()
+    release = threading.Event()
+    outcome = []
+
+    def holder():
+        with governor.generation("t", "holder"):
+            holding.set()
+            release.wait()
+            governor.ledger.record("t", "holder", 150)
+
+    def queued():
+        try:
+            with governor.generation("t", "queued"):
+                outcome.append("admitted")
+        except BudgetExceeded as e:
+            outcome.append(e.scope)
+
+    threads = [threading.Thread(target=holder), threading.Thread(target=queued)]
+    threads[0].start()
+    assert holding.wait(2.0)
+    threads[1].start()
+    assert _wait_until(lambda: governor.scheduler.pending == 1) # Passed the enqueue-time check
+    release.set()
+    for t in threads:
+        t.join(timeout=2.0)
+    assert outcome == ["institution"]
+    assert governor.scheduler._active == 0 # Slot released on refusal
+
+
+def test_zero_window_and_half_life_are_clamped(monkeypatch):
+    monkeypatch.setenv("OSCE_BUDGET_WINDOW_SECONDS", "0")
+    monkeypatch.setenv("OSCE_FAIR_SHARE_HALF_LIFE_SECONDS", "0")
+    monkeypatch.setenv("OSCE_TENANT_TOKEN_BUDGET", "100")
+    governor = TokenGovernor.from_env()
+    assert governor.ledger.window_seconds == 1
+    assert governor.ledger.half_life_seconds == 1
+    governor.ledger.record("t", "s", 150)
+    with pytest.raises(BudgetExceeded):
+        governor.check_budget("t", "s")
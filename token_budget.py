@@ -0,0 +1,304 @@
+import os
+import time
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# --- Configuration (environment variables) ---
+# Budgets are token counts per rolling window; 0 means unlimited.
+STUDENT_BUDGET_ENV_VAR = "OSCE_STUDENT_TOKEN_BUDGET"
+TENANT_BUDGET_ENV_VAR = "OSCE_TENANT_TOKEN_BUDGET"
+BUDGET_WINDOW_ENV_VAR = "OSCE_BUDGET_WINDOW_SECONDS"
+MAX_CONCURRENT_ENV_VAR = "OSCE_MAX_CONCURRENT_GENERATIONS"
+HALF_LIFE_ENV_VAR = "OSCE_FAIR_SHARE_HALF_LIFE_SECONDS"
+
+DEFAULT_TENANT = "default"
+DEFAULT_BUDGET_WINDOW = 24 * 60 * 60 # One day
+DEFAULT_MAX_CONCURRENT = 4
+DEFAULT_HALF_LIFE = 10 * 60 # Recent consumption halves every ten minutes
+DEFAULT_TENANT_WEIGHT = 0.5 # How much a tenant's usage counts against each of its students
+EVICT_SWEEP_INTERVAL = 60 # Seconds between sweeps for idle ledger keys
+EVICT_BELOW_TOKENS = 1.0 # Decayed score below which an idle key is forgotten
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised before a generation (on request and again on admission) when the student or
+    tenant has used up its token budget.
+    """
+
+    def __init__(self, scope: str, name: str, used: int, limit: int):
+        self.scope = scope
+        self.name = name
+        self.used = used
+        self.limit = limit
+        super().__init__(f"Token budget exhausted for {scope} '{name}' ({used}/{limit} tokens used).")
+
+
+def _int_from_env(name: str, default: int) -> int:
+    try:
+        return max(int(os.getenv(name, default)), 0)
+    except ValueError:
+        return default
+
+
+def usage_tokens(response) -> int:
+    """
+    Returns the total tokens billed for a GenerateContentResponse, from its usage metadata.
+    Falls back to prompt + candidate tokens, and to 0 if the response carries no metadata.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return 0
+    total = getattr(usage, "total_token_count", None)
+    if total:
+        return total
+    return (getattr(usage, "prompt_token_count", None) or 0) + (getattr(usage, "candidates_token_count", None) or 0)
+
+
+class TokenLedger:
+    """
+    Thread-safe per-student and per-tenant token accounting.
+    Keeps rolling-window totals for budget enforcement and an exponentially decayed
+    'recent consumption' score for fair-share ordering. Keys with nothing left in the
+    window and a negligible recent score are evicted (their lifetime total with them),
+    so one-off browser sessions do not accumulate forever.
+    """
+
+    def __init__(self,
+                 window_seconds: float = DEFAULT_BUDGET_WINDOW,
+                 half_life_seconds: float = DEFAULT_HALF_LIFE,
+                 clock=time.monotonic):
+        # A zero window would drop every event at once (budgets never bite) and a zero
+        # half-life would stop decay (no eviction, lifetime ranking), so clamp both.
+        self.window_seconds = max(window_seconds, 1)
+        self.half_life_seconds = max(half_life_seconds, 1)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._events = {} # key -> deque of (timestamp, tokens) inside the window
+        self._window_totals = {}
+        self._recent = {} # key -> (decayed score, last update timestamp)
+        self._lifetime = {}
+        self._last_sweep = clock()
+
+    def _decayed(self, key, now: float) -> float:
+        score, updated_at = self._recent.get(key, (0.0, now))
+        return score * 0.5 ** ((now - updated_at) / self.half_life_seconds)
+
+    def _prune(self, key, now: float):
+        events = self._events.get(key)
+        if not events:
+            return
+        cutoff = now - self.window_seconds
+        while events and events[0][0] <= cutoff:
+            _, tokens = events.popleft()
+            self._window_totals[key] -= tokens
+
+    def _evict_idle(self, now: float):
+        for key in list(self._lifetime):
+            self._prune(key, now)
+            if self._window_totals.get(key, 0) <= 0 and self._decayed(key, now) < EVICT_BELOW_TOKENS:
+                for store in (self._events, self._window_totals, self._recent, self._lifetime):
+                    store.pop(key, None)
+        self._last_sweep = now
+
+    def record(self, tenant: str, student: str, tokens: int):
+        if tokens <= 0:
+            return
+        now = self._clock()
+        with self._lock:
+            for key in (("tenant", tenant), ("student", tenant, student)):
+                self._prune(key, now)
+                self._events.setdefault(key, deque()).append((now, tokens))
+                self._window_totals[key] = self._window_totals.get(key, 0) + tokens
+                self._recent[key] = (self._decayed(key, now) + tokens, now)
+                self._lifetime[key] = self._lifetime.get(key, 0) + tokens
+            if now - self._last_sweep >= EVICT_SWEEP_INTERVAL:
+                self._evict_idle(now)
+
+    def __len__(self) -> int:
+        """
+        Number of tenant and student keys currently tracked.
+        """
+        with self._lock:
+            return len(self._lifetime)
+
+    def window_usage(self, tenant: str, student: str = None) -> int:
+        key = ("tenant", tenant) if student is None else ("student", tenant, student)
+        with self._lock:
+            self._prune(key, self._clock())
+            return self._window_totals.get(key, 0)
+
+    def recent_usage(self, tenant: str, student: str = None) -> float:
+        key = ("tenant", tenant) if student is None else ("student", tenant, student)
+        with self._lock:
+            return self._decayed(key, self._clock())
+
+    def snapshot(self) -> list:
+        """
+        Returns one row per tenant and student with window, recent and lifetime usage.
+        """
+        now = self._clock()
+        with self._lock:
+            self._evict_idle(now)
+            rows = []
+            for key in sorted(self._lifetime):
+                rows.append({
+                    "tenant": key[1],
+                    "student": key[2] if key[0] == "student" else "(all)",
+                    "window_tokens": self._window_totals.get(key, 0),
+                    "recent_tokens": round(self._decayed(key, now)),
+                    "lifetime_tokens": self._lifetime[key],
+                })
+            return rows
+
+
+class FairShareScheduler:
+    """
+    Admits at most `max_concurrent` generations at a time. When callers have to wait,
+    the pending generation whose student (and tenant) consumed the fewest tokens
+    recently goes next, so light users keep low latency while heavy users contend.
+    With fair_share=False waiting callers are admitted first-come, first-served.
+    """
+
+    def __init__(self,
+                 ledger: TokenLedger,
+                 max_concurrent: int = DEFAULT_MAX_CONCURRENT,
+                 tenant_weight: float = DEFAULT_TENANT_WEIGHT,
+                 fair_share: bool = True):
+        self.ledger = ledger
+        self.max_concurrent = max(max_concurrent, 1)
+        self.tenant_weight = tenant_weight
+        self.fair_share = fair_share
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = {} # ticket -> (tenant, student)
+        self._tickets = itertools.count()
+
+    def priority(self, tenant: str, student: str) -> float:
+        """
+        Lower runs first: the student's recent consumption plus a share of its tenant's.
+        """
+        return (self.ledger.recent_usage(tenant, student)
+                + self.tenant_weight * self.ledger.recent_usage(tenant))
+
+    def _next_ticket(self):
+        if not self.fair_share:
+            return min(self._waiting)
+        # Ticket number breaks ties so equal consumers stay first-come, first-served.
+        return min(self._waiting, key=lambda t: (self.priority(*self._waiting[t]), t))
+
+    def reprioritize(self):
+        """
+        Wakes waiters to re-evaluate the queue head after recorded usage changed priorities.
+        """
+        with self._condition:
+            self._condition.notify_all()
+
+    @property
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._waiting)
+
+    @contextmanager
+    def slot(self, tenant: str, student: str):
+        ticket = next(self._tickets)
+        with self._condition:
+            self._waiting[ticket] = (tenant, student)
+            try:
+                while self._active >= self.max_concurrent or self._next_ticket() != ticket:
+                    self._condition.wait()
+            finally:
+                del self._waiting[ticket]
+                # Waiters that re-checked while this ticket was still the head went back to
+                # sleep; wake them so the new head can take any slot that is still free.
+                self._condition.notify_all()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+
+class GenerationTicket:
+    """
+    Handed to the caller inside TokenGovernor.generation(); call record() with the response.
+    """
+
+    def __init__(self, scheduler: FairShareScheduler, tenant: str, student: str):
+        self._scheduler = scheduler
+        self.tenant = tenant
+        self.student = student
+        self.tokens = 0
+
+    def record(self, response) -> int:
+        self.tokens = usage_tokens(response)
+        self._scheduler.ledger.record(self.tenant, self.student, self.tokens)
+        self._scheduler.reprioritize()
+        return self.tokens
+
+
+class TokenGovernor:
+    """
+    Enforces per-student and per-tenant token budgets and schedules generations fairly.
+    Usage:
+        with governor.generation(tenant, student) as ticket:
+            response = client.models.generate_content(...)
+            ticket.record(response)
+    """
+
+    def __init__(self,
+                 ledger: TokenLedger,
+                 student_budget: int = 0,
+                 tenant_budget: int = 0,
+                 max_concurrent: int = DEFAULT_MAX_CONCURRENT,
+                 fair_share: bool = True):
+        self.ledger = ledger
+        self.student_budget = student_budget
+        self.tenant_budget = tenant_budget
+        self.scheduler = FairShareScheduler(ledger, max_concurrent=max_concurrent, fair_share=fair_share)
+
+    @classmethod
+    def from_env(cls) -> "TokenGovernor":
+        ledger = TokenLedger(
+            window_seconds=_int_from_env(BUDGET_WINDOW_ENV_VAR, DEFAULT_BUDGET_WINDOW),
+            half_life_seconds=_int_from_env(HALF_LIFE_ENV_VAR, DEFAULT_HALF_LIFE)
+        )
+        return cls(
+            ledger,
+            student_budget=_int_from_env(STUDENT_BUDGET_ENV_VAR, 0),
+            tenant_budget=_int_from_env(TENANT_BUDGET_ENV_VAR, 0),
+            max_concurrent=_int_from_env(MAX_CONCURRENT_ENV_VAR, DEFAULT_MAX_CONCURRENT)
+        )
+
+    def check_budget(self, tenant: str, student: str):
+        """
+        Raises BudgetExceeded if the student or its tenant has no budget left in the window.
+        """
+        if self.tenant_budget:
+            used = self.ledger.window_usage(tenant)
+            if used >= self.tenant_budget:
+                raise BudgetExceeded("institution", tenant, used, self.tenant_budget)
+        if self.student_budget:
+            used = self.ledger.window_usage(tenant, student)
+            if used >= self.student_budget:
+                raise BudgetExceeded("student", student, used, self.student_budget)
+
+    @contextmanager
+    def generation(self, tenant: str, student: str, check_budget: bool = True):
+        """
+        Admits one generation: checks budgets, then waits for a fair-share slot.
+        check_budget=False still schedules and records usage but never refuses, for calls
+        that must complete once started (e.g. feedback on a consultation already under way).
+        """
+        if check_budget:
+            self.check_budget(tenant, student) # Fail fast rather than queue a doomed call
+        with self.scheduler.slot(tenant, student):
+            if check_budget:
+                # Re-check on admission: calls admitted ahead of this one may have used up
+                # the window while it waited. Raising here releases the slot.
+                self.check_budget(tenant, student)
+            yield GenerationTicket(self.scheduler, tenant, student)